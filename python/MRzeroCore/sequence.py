@@ -76,6 +76,44 @@ class Pulse:
         self.shim_array = shim_array
         self.selective = selective
 
+    # angle, phase and shim_array are always stored as tensors, so that the
+    # simulation does not need to convert them on every repetition
+
+    @property
+    def angle(self) -> torch.Tensor:
+        """Flip angle in radians"""
+        return self._angle
+
+    @angle.setter
+    def angle(self, angle: torch.Tensor | float):
+        self._angle = torch.as_tensor(angle)
+
+    @property
+    def phase(self) -> torch.Tensor:
+        """Pulse phase in radians"""
+        return self._phase
+
+    @phase.setter
+    def phase(self, phase: torch.Tensor | float):
+        self._phase = torch.as_tensor(phase)
+
+    @property
+    def shim_array(self) -> torch.Tensor:
+        """B1 mag and phase per channel, shape (channels, 2)"""
+        return self._shim_array
+
+    @shim_array.setter
+    def shim_array(self, shim_array: torch.Tensor):
+        self._shim_array = torch.as_tensor(shim_array)
+
+    def __setstate__(self, state: dict):
+        # Pulses pickled before these attributes became properties store
+        # them under their public names
+        for name in ["angle", "phase", "shim_array"]:
+            if name in state:
+                state["_" + name] = torch.as_tensor(state.pop(name))
+        self.__dict__.update(state)
+
     def cpu(self) -> Pulse:
         """Move this pulse to the CPU and return it."""
         return Pulse(
@@ -3,7 +3,7 @@ import torch
 
 from ..sequence import Sequence
 from ..phantom.sim_data import SimData
-from .pre_pass import Graph
+from .pre_pass import Graph, ANCESTOR_OPS
 import numpy as np
 
 
@@ -20,11 +20,177 @@ def rigid_motion(voxel_pos, motion_func):
         rot, offset = motion_func(time)
         rot = rot.to(device=voxel_pos.device)
         offset = offset.to(device=voxel_pos.device)
-        return torch.einsum("vi, eij -> evj", voxel_pos, rot) + offset[:, None, :]
+        # (voxels x 3) @ (events x 3 x 3): one batched matmul
+        return torch.matmul(voxel_pos, rot) + offset[:, None, :]
 
     return voxel_motion
 
 
+def _signal_kernel(
+    mag: torch.Tensor,
+    adc_dist_traj: torch.Tensor,
+    adc_cum_b: torch.Tensor | None,
+    adc_time: torch.Tensor,
+    adc_motion_phase: torch.Tensor | float,
+    dephasing: torch.Tensor,
+    D: torch.Tensor,
+    inv_T2: torch.Tensor,
+    inv_T2dash: torch.Tensor,
+    pos_aug: torch.Tensor,
+    coil_weights: torch.Tensor,
+    return_mag: bool = False,
+) -> tuple[torch.Tensor, torch.Tensor | None]:
+    """Calculate the signal emitted by a batch of "+" states.
+
+    Contains only real tensor operations, so it can be compiled as a whole
+    (torch.compile doesn't generate code for complex operations). Complex
+    tensors are passed and returned as real views with a trailing (re, im)
+    dimension, see :func:`torch.view_as_real`. Shapes:
+    mag is (dists x voxels x 2), adc_dist_traj (dists x events x 4), adc_cum_b
+    (dists x events), adc_time (events x 1), adc_motion_phase (events x voxels)
+    or 0, dephasing (dists x events) and pos_aug (voxels x 4), which are
+    the voxel positions with B0 appended, matching the (k, tau) trajectory.
+    coil_weights (2 x voxels x coils * 2) are the coil sensitivities as
+    [[re, im], [-im, re]] for the real and imaginary part of the
+    magnetisation, with (re, im) interleaved per coil.
+    If adc_cum_b is None, diffusion is not simulated.
+
+    Returns the summed signal (events x coils * 2) and, if return_mag is set,
+    the transversal magnetisation of every state (dists x events x voxels x 2).
+    """
+    # shape: dists x events x voxels
+    # applies the well‐known exponential attenuation factor to
+    # every voxel at every measured time step
+    if adc_cum_b is None:
+        diffusion = None
+    else:
+        diffusion = torch.exp(-1e-9 * D * adc_cum_b[:, :, None])
+    T2 = torch.exp(-adc_time * inv_T2)
+    T2dash = torch.exp(-torch.abs(adc_dist_traj[:, :, 3:]) * inv_T2dash)
+    dephasing = dephasing[:, :, None]
+    # k @ pos + tau * B0 as a single matmul
+    phase = 2 * np.pi * (adc_dist_traj @ pos_aug.T + adc_motion_phase)
+    cos = torch.cos(phase)
+    sin = torch.sin(phase)
+
+    # All attenuation factors are real, combine them before applying them to
+    # the magnetisation.
+    atten = 1.41421356237 * T2 * T2dash * dephasing
+    if diffusion is not None:
+        atten = atten * diffusion
+
+    # mag * exp(i * phase) * atten in real and imaginary part
+    # shape: dists x events x voxels
+    mag_re = mag[:, None, :, 0]
+    mag_im = mag[:, None, :, 1]
+    transverse_re = atten * (mag_re * cos - mag_im * sin)
+    transverse_im = atten * (mag_re * sin + mag_im * cos)
+
+    # (dists x events x voxels) @ (voxels x coils), summed over all dists
+    # = (events x coils), the complex product as two real contractions
+    signal = (
+        torch.einsum("dev, vc -> ec", transverse_re, coil_weights[0])
+        + torch.einsum("dev, vc -> ec", transverse_im, coil_weights[1])
+    )
+    if return_mag:
+        return signal, torch.stack([transverse_re, transverse_im], -1)
+    return signal, None
+
+
+# Upper bound for the (dists x events x voxels) size of a signal kernel batch
+_MAX_BATCH_ELEMENTS = 2**20
+
+_compiled_kernels = {}
+
+
+def _get_signal_kernel(kernel: str, device: torch.device):
+    """Return :func:`_signal_kernel`, compiled if requested.
+
+    With ``"cudagraphs"``, the compiled kernel is captured into CUDA graphs
+    and replayed for every repetition (``mode="reduce-overhead"``). Replays
+    overwrite the outputs of the previous one, so this is only allowed on
+    CUDA and with autograd disabled.
+    """
+    if kernel == "eager":
+        return _signal_kernel
+    elif kernel in ["compile", "cudagraphs"]:
+        if not hasattr(torch, "compile"):
+            raise ValueError(f'kernel="{kernel}" requires PyTorch >= 2.0')
+        cuda_graphs = kernel == "cudagraphs"
+        if cuda_graphs and device.type != "cuda":
+            raise ValueError('kernel="cudagraphs" requires a CUDA device')
+        if cuda_graphs and torch.is_grad_enabled():
+            raise ValueError(
+                'kernel="cudagraphs" is only supported inside torch.no_grad()'
+            )
+        key = kernel
+        if key not in _compiled_kernels:
+            # The event count changes between repetitions and the state count
+            # between batches: compile once for dynamic shapes. CUDA graphs
+            # are still recorded for every distinct shape.
+            compiled = torch.compile(
+                _signal_kernel,
+                mode="reduce-overhead" if cuda_graphs else None,
+                dynamic=True,
+            )
+            mark_step = getattr(
+                getattr(torch, "compiler", None), "cudagraph_mark_step_begin", None
+            )
+            # Every combination of the optional inputs (motion, diffusion) is
+            # a separate graph, which can exceed the default limit of 8
+            # recompilations
+            config = torch._dynamo.config
+            limit_name = (
+                "recompile_limit" if hasattr(config, "recompile_limit")
+                else "cache_size_limit"
+            )
+            limit = {limit_name: max(getattr(config, limit_name), 64)}
+
+            def run(*args):
+                if cuda_graphs and mark_step is not None:
+                    # Outputs of the previous replay are consumed already
+                    mark_step()
+                with config.patch(**limit):
+                    return compiled(*args)
+
+            if cuda_graphs:
+                _compiled_kernels[key] = _padded_kernel(run)
+            else:
+                _compiled_kernels[key] = run
+        return _compiled_kernels[key]
+    else:
+        raise ValueError(f"Unknown kernel {kernel}")
+
+
+def _padded_kernel(kernel):
+    """Pad the state count of all kernel calls to the next power of two.
+
+    CUDA graphs are recorded for every distinct input shape. Sequences only
+    use a few different event counts per repetition, but the number of
+    measured states varies a lot. Padded states have zero magnetisation and
+    don't contribute to the signal.
+    """
+    def padded(mag, adc_dist_traj, adc_cum_b, adc_time, adc_motion_phase,
+               dephasing, *args):
+        count = mag.shape[0]
+        padding = (1 << (count - 1).bit_length()) - count
+        if padding > 0:
+            mag, adc_dist_traj, adc_cum_b, dephasing = [
+                None if t is None
+                else torch.cat([t, t.new_zeros(padding, *t.shape[1:])])
+                for t in [mag, adc_dist_traj, adc_cum_b, dephasing]
+            ]
+        signal, transverse_mag = kernel(
+            mag, adc_dist_traj, adc_cum_b, adc_time, adc_motion_phase,
+            dephasing, *args
+        )
+        if transverse_mag is not None:
+            transverse_mag = transverse_mag[:count]
+        return signal, transverse_mag
+
+    return padded
+
+
 def execute_graph(
     graph: Graph,
     seq: Sequence,
@@ -35,6 +201,8 @@ def execute_graph(
     return_mag_adc=False,
     clear_state_mag=True,
     intitial_mag: torch.Tensor | None = None,
+    kernel: str = "eager",
+    max_batch_states: int | None = None,
 ) -> torch.Tensor | list:
     """Calculate the signal of the sequence by executing the phase graph.
 
@@ -62,6 +230,20 @@ def execute_graph(
     initial_mag: Tensor | None
         If set, simulation does not start with a fully relaxed state but the
         given magnetization. Must be a complex 1D tensor with voxel_count elements.
+    kernel: str
+        One of ``"eager"``, ``"compile"`` or ``"cudagraphs"``. If
+        ``"compile"``, the signal calculation of the "+" states is fused with
+        :func:`torch.compile` (requires PyTorch >= 2.0). Compilation takes
+        some time on the first call, so this pays off for long sequences and
+        repeated simulations. ``"cudagraphs"`` additionally captures the
+        compiled kernel as CUDA graphs, which removes the kernel launch
+        overhead. It is only supported for forward simulations on CUDA,
+        inside of ``torch.no_grad()``.
+    max_batch_states: int | None
+        Maximum number of measured "+" states whose signal is calculated at
+        once. Larger batches are faster but need memory proportional to
+        states x adc samples x voxels. If None, the batch size is chosen so
+        that this product stays below ~1 million elements.
 
     Returns
     -------
@@ -96,14 +278,40 @@ def execute_graph(
         grad_scale = 1 / data.size
     else:
         grad_scale = torch.ones_like(data.size)
-    signal: list[torch.Tensor] = []
+
+    # Relaxation rates and PD don't change between repetitions
+    inv_T1 = 1 / torch.abs(data.T1)
+    inv_T2 = 1 / torch.abs(data.T2)
+    inv_T2dash = 1 / torch.abs(data.T2dash)
+    abs_PD = torch.abs(data.PD)
+    # SimData clamps D to >= 1e-6, which is not distinguishable from zero
+    diffusion_enabled = data.D.requires_grad or bool((data.D > 1e-6).any())
 
     # Proton density can be baked into coil sensitivity. shape: voxels x coils
-    coil_sensitivity = data.coil_sens.t().to(torch.cfloat) * torch.abs(
-        data.PD
-    ).unsqueeze(1)
+    coil_sensitivity = data.coil_sens.t().to(torch.cfloat) * abs_PD.unsqueeze(1)
     coil_count = int(coil_sensitivity.shape[1])
+    # Real weights of the signal contraction, see _signal_kernel
+    # shape: 2 x voxels x (coils * 2)
+    coil_weights = torch.stack([
+        torch.stack([coil_sensitivity.real, coil_sensitivity.imag], -1),
+        torch.stack([-coil_sensitivity.imag, coil_sensitivity.real], -1),
+    ]).flatten(2)
     voxel_count = data.PD.numel()
+    signal_kernel = _get_signal_kernel(kernel, data.device)
+    if max_batch_states is not None and max_batch_states < 1:
+        raise ValueError(
+            f"max_batch_states must be at least 1, got {max_batch_states}"
+        )
+
+    # The number of measured samples is known in advance: the signal of every
+    # repetition is written into its slice of one preallocated tensor
+    adc_offsets = np.cumsum([0] + [int((rep.adc_usage > 0).sum()) for rep in seq])
+    signal = torch.zeros(
+        int(adc_offsets[-1]), coil_count, dtype=torch.cfloat, device=data.device
+    )
+    # Voxel position and B0, matching the (kx, ky, kz, tau) trajectory
+    # shape: voxels x 4
+    pos_aug = torch.cat([data.voxel_pos, data.B0[:, None]], dim=1)
 
     # The first repetition contains only one element: A fully relaxed z0
     if intitial_mag is None:
@@ -123,9 +331,9 @@ def execute_graph(
         if print_progress:
             print(f"\rCalculating repetition {i + 1} / {len(seq)}", end="")
 
-        angle = torch.as_tensor(rep.pulse.angle)
-        phase = torch.as_tensor(rep.pulse.phase)
-        shim_array = torch.as_tensor(rep.pulse.shim_array)
+        angle = rep.pulse.angle
+        phase = rep.pulse.phase
+        shim_array = rep.pulse.shim_array
 
         # 1Tx or pTx?
         if shim_array.shape[0] == 1:
@@ -142,37 +350,35 @@ def execute_graph(
         angle = angle * B1.abs()
         phase = phase + B1.angle()
 
+        # All coefficients are built from sin / cos of the half angle:
+        # cos(a) = 1 - 2 sin²(a/2), sin(a) = 2 sin(a/2) cos(a/2)
+        sin_half = torch.sin(angle / 2)
+        cos_half = torch.cos(angle / 2)
+        pulse_rot = torch.polar(torch.ones_like(phase), phase)
         # Unaffected magnetisation
-        z_to_z = torch.cos(angle)
-        p_to_p = torch.cos(angle / 2) ** 2
+        z_to_z = 1 - 2 * sin_half * sin_half
+        p_to_p = cos_half * cos_half
         # Excited magnetisation
-        z_to_p = -0.70710678118j * torch.sin(angle) * torch.exp(1j * phase)
+        z_to_p = -0.70710678118j * (2 * sin_half * cos_half) * pulse_rot
         p_to_z = -z_to_p.conj()
         m_to_z = -z_to_p
         # Refocussed magnetisation
-        m_to_p = (1 - p_to_p) * torch.exp(2j * phase)
-
-        def calc_mag(ancestor: tuple) -> torch.Tensor:
-            if ancestor[0] == "zz":
-                return ancestor[1].mag * z_to_z
-            elif ancestor[0] == "++":
-                return ancestor[1].mag * p_to_p
-            elif ancestor[0] == "z+":
-                return ancestor[1].mag * z_to_p
-            elif ancestor[0] == "+z":
-                return ancestor[1].mag * p_to_z
-            elif ancestor[0] == "-z":
-                return ancestor[1].mag.conj() * m_to_z
-            elif ancestor[0] == "-+":
-                return ancestor[1].mag.conj() * m_to_p
-            else:
-                raise ValueError(f"Unknown transform {ancestor[0]}")
+        m_to_p = (sin_half * sin_half) * (pulse_rot * pulse_rot)
+
+        # shape: 6 x voxels, indexed by the opcodes of pre_pass.ANCESTOR_OPS
+        coeffs = torch.stack([
+            z_to_z.to(z_to_p.dtype),
+            p_to_p.to(z_to_p.dtype),
+            z_to_p,
+            p_to_z,
+            m_to_z,
+            m_to_p,
+        ])
 
-        # shape: events x coils
         adc = rep.adc_usage > 0
-        rep_sig = torch.zeros(
-            adc.sum(), coil_count, dtype=torch.cfloat, device=data.device
-        )
+        # Indexing with the sample indices is a direct gather, indexing with
+        # the bool mask would recompute them on every use
+        adc_idx = adc.nonzero(as_tuple=True)[0]
         """
         adc shape torch.Size([12])
         adc shape torch.Size([4117])
@@ -184,18 +390,46 @@ def execute_graph(
         adc shape torch.Size([4110])
         """
         # --------------------------- Build k–τ trajectory --------------------------- #
+        # shape: events x 3
+        gradm = rep.gradm * grad_scale[None, :]
         # shape: events x 4
         trajectory = torch.cumsum(
-            torch.cat([rep.gradm * grad_scale[None, :], rep.event_time[:, None]], 1), 0
+            torch.cat([gradm, rep.event_time[:, None]], 1), 0
         )
         dt = rep.event_time
 
+        # Diffusion: the b-factor integrand of a state starting at kt0 is
+        # k1² + k1·k2 + k2² with k1 = kt0 + p, k2 = kt0 + q (k-space at start
+        # and end of an event). Expanded, this is the polynomial
+        # (p + q)² - p·q + 3 kt0·(p + q) + 3 kt0², so everything but kt0 is
+        # shared by all states of the repetition.
+        # Skipped if the phantom has no diffusion.
+        if diffusion_enabled:
+            q = trajectory[:, :3]
+            p = torch.nn.functional.pad(q[:-1, :], (0, 0, 1, 0))
+            pq = p + q
+            # Integrate over each event to get b factor (lin. interp. grad)
+            # Gradients are in rotations / meter, but we need rad / meter,
+            # as integrating over exp(-ikr) assumes that kr is a phase in rad
+            # b is a linear combination of these per-repetition terms, so its
+            # cumulative sum over events is split the same way and only
+            # computed once for all states.
+            b_scale = 1 / 3 * (2 * torch.pi) ** 2 * dt
+            cum_b_grad = torch.cumsum(b_scale * (pq**2 - p * q).sum(1), 0)  # shape: events
+            cum_b_lin = torch.cumsum(3 * b_scale[:, None] * pq, 0)  # shape: events x 3
+            cum_b_sq = torch.cumsum(3 * b_scale, 0)  # shape: events
+
         total_time = rep.event_time.sum()
-        r1 = torch.exp(-total_time / torch.abs(data.T1))  # longitudinal recovery factor
-        r2 = torch.exp(-total_time / torch.abs(data.T2))  # transverse decay factor
+        r1 = torch.exp(-total_time * inv_T1)  # longitudinal recovery factor
+        r2 = torch.exp(-total_time * inv_T2)  # transverse decay factor
 
-        # Use the same adc phase for all coils
-        adc_rot = torch.exp(1j * rep.adc_phase).unsqueeze(1)
+        # Use the same adc phase for all coils, only needed for measured samples
+        adc_phase = rep.adc_phase[adc_idx]
+        adc_rot = torch.polar(adc_phase.new_ones(()), adc_phase).unsqueeze(1)
+        if return_mag_adc:
+            # adc phase and PD applied to the measured magnetisation, as one
+            # factor for all states. shape: events x voxels
+            pd_adc_rot = adc_rot * abs_PD[None, :]
 
         # --------------------------- Motion‐induced phase --------------------------- #
         # Calculate the additional phase carried of voxels because of motion
@@ -204,13 +438,15 @@ def execute_graph(
             time = t0 + torch.cat(
                 [torch.zeros(1, device=data.device), trajectory[:, 3]]
             )
+            # NOTE: Subtract the static positions before contracting with
+            # the gradients, the difference of the phases is much less precise
             # Shape: events x voxels x 3
             voxel_traj = (
                 voxel_pos_func((time[:-1] + time[1:]) / 2) - data.voxel_pos[None, :, :]
             )
             # Shape: events x voxels
             motion_phase = torch.einsum(
-                "evi, ei -> ev", voxel_traj, rep.gradm * grad_scale[None, :]
+                "evi, ei -> ev", voxel_traj, gradm
             ).cumsum(0)
         t0 += total_time
 
@@ -222,38 +458,42 @@ def execute_graph(
         # then project onto coils.
         mag_adc_rep = []
         mag_adc.append(mag_adc_rep)
-        for dist in dists:
+
+        # First walk over all states: apply the RF pulse and collect the
+        # simulated ones. The "+" states are then processed together, their
+        # signal is calculated in batches of bounded size.
+        plus_dists = []
+        for dist_idx, dist in enumerate(dists):
             # Create a list only containing ancestors that were simulated
-            ancestors = list(
-                filter(lambda edge: edge[1].mag is not None, dist.ancestors)
-            )
+            simulated = [
+                j for j, edge in enumerate(dist.ancestors)
+                if edge[1].mag is not None
+            ]
+            ancestors = [dist.ancestors[j] for j in simulated]
 
             if dist.dist_type != "z0" and dist.latent_signal < min_latent_signal:
                 continue  # skip unimportant distributions
             if dist.dist_type != "z0" and len(ancestors) == 0:
                 continue  # skip dists for which no ancestors were simulated
 
-            dist.mag = sum([calc_mag(ancestor) for ancestor in ancestors])
-            """
-            print(f"calc_mag: {ancestor[0]} {ancestor[1].mag} {ancestor[1].kt_vec}")
-            calc_mag: zz tensor([1.+0.j, 1.+0.j, 1.+0.j,  ..., 1.+0.j, 1.+0.j, 1.+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: z+ tensor([1.+0.j, 1.+0.j, 1.+0.j,  ..., 1.+0.j, 1.+0.j, 1.+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: zz tensor([0.2528+0.j, 0.2050+0.j, 0.2014+0.j,  ..., 0.1822+0.j, 0.1817+0.j, 0.1998+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: -+ tensor([0.-0.5545j, 0.-0.6221j, 0.-0.6225j,  ..., 0.-0.6582j, 0.-0.6582j,
-                    0.-0.6227j]) tensor([0.0000e+00, 0.0000e+00, 3.2096e+03, 4.6540e-02])
-            
-            calc_mag: zz tensor([0.9999+0.j, 0.9898+0.j, 0.9898+0.j,  ..., 0.8917+0.j, 0.8917+0.j, 0.9898+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: z+ tensor([0.9999+0.j, 0.9898+0.j, 0.9898+0.j,  ..., 0.8917+0.j, 0.8917+0.j, 0.9898+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: zz tensor([0.2528+0.j, 0.2034+0.j, 0.1998+0.j,  ..., 0.1649+0.j, 0.1644+0.j, 0.1982+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: -+ tensor([0.-0.5545j, 0.-0.6157j, 0.-0.6162j,  ..., 0.-0.5869j, 0.-0.5870j,
-                    0.-0.6163j]) tensor([0.0000e+00, 0.0000e+00, 3.2096e+03, 4.6540e-02])
-            
-            calc_mag: zz tensor([0.9999+0.j, 0.9898+0.j, 0.9898+0.j,  ..., 0.8932+0.j, 0.8932+0.j, 0.9899+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: z+ tensor([0.9999+0.j, 0.9898+0.j, 0.9898+0.j,  ..., 0.8932+0.j, 0.8932+0.j, 0.9899+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: zz tensor([0.2528+0.j, 0.2034+0.j, 0.1998+0.j,  ..., 0.1651+0.j, 0.1646+0.j, 0.1982+0.j]) tensor([0., 0., 0., 0.])
-            calc_mag: -+ tensor([0.-0.3394j, 0.-0.2307j, 0.-0.2309j,  ..., 0.-0.0826j, 0.-0.0826j,
-                    0.-0.2310j]) tensor([1.7003e+04, 1.7003e+04, 2.0213e+04, 4.6540e-02])
-            """
+            if len(ancestors) == 1:
+                # Most states have a single ancestor: no stack / reduction
+                op, conj = ANCESTOR_OPS[ancestors[0][0]]
+                parent_mag = ancestors[0][1].mag
+                dist.mag = coeffs[op] * (parent_mag.conj() if conj else parent_mag)
+            else:
+                # Opcodes are only built for states with several ancestors
+                op_idx, conj_mask = graph.ancestor_ops(i + 1, data.device)[dist_idx]
+                if len(simulated) < len(dist.ancestors):
+                    op_idx = op_idx[simulated]
+                    conj_mask = conj_mask[simulated]
+                # shape: ancestors x voxels
+                parent_mags = torch.stack([edge[1].mag for edge in ancestors])
+                parent_mags = torch.where(
+                    conj_mask[:, None], parent_mags.conj(), parent_mags
+                )
+                dist.mag = (coeffs[op_idx] * parent_mags).sum(0)
+
             # The pre_pass already calculates kt_vec, but that does not
             # work with autograd -> we need to calculate it with torch
             if dist.dist_type == "z0":
@@ -263,179 +503,145 @@ def execute_graph(
             else:
                 dist.kt_vec = ancestors[0][1].kt_vec.clone()
 
-            # shape: events x 4
-            dist_traj = dist.kt_vec + trajectory
-            """
-            dist_traj shape torch.Size([12, 4])
-            dist_traj shape torch.Size([12, 4])
-            dist_traj shape torch.Size([4117, 4])
-            dist_traj shape torch.Size([4117, 4])
-
-            dist_traj shape torch.Size([12, 4])
-            dist_traj shape torch.Size([12, 4])
-            dist_traj shape torch.Size([4119, 4])
-            dist_traj shape torch.Size([4119, 4])
-            
-            dist_traj shape torch.Size([15, 4])
-            dist_traj shape torch.Size([15, 4])
-            dist_traj shape torch.Size([4110, 4])
-            dist_traj shape torch.Size([4110, 4])
-            """
-
-            # NOTE: Extract the diffusion signal and return it
+            # Prepare each state's dist.mag and kt_vec for the next TR:
+            # Carry‐over: the z(0) states are decayed by diffusion and T1
+            # recovery. The "+" states are handled below.
+            if dist.dist_type == "+":
+                plus_dists.append(dist)
+            else:  # z or z0
+                dist.mag = dist.mag * r1
+                if diffusion_enabled:
+                    k = torch.linalg.vector_norm(dist.kt_vec[:3])
+                    dist.mag = dist.mag * torch.exp(
+                        -1e-9 * data.D * total_time * k**2
+                    )
+            if dist.dist_type == "z0":
+                dist.mag = dist.mag + 1 - r1
+
+        if len(plus_dists) > 0:
+            # shape: dists x voxels
+            mag_stack = torch.stack([dist.mag for dist in plus_dists])
+            # shape: dists x 4
+            kt_stack = torch.stack([dist.kt_vec for dist in plus_dists])
+            # Indices of all states that are measured
+            emitting = [
+                j for j, dist in enumerate(plus_dists)
+                if dist.emitted_signal >= min_emitted_signal
+            ]
+
+            # shape: dists x events x 4
+            dist_traj = kt_stack[:, None, :] + trajectory[None, :, :]
+
             # Diffusion
-            k2 = dist_traj[:, :3]
-            k1 = torch.empty_like(k2)  # Calculate k-space at start of event
-            k1[0, :] = dist.kt_vec[:3]
-            k1[1:, :] = k2[:-1, :]
-            
-            # Integrate over each event to get b factor (lin. interp. grad)
-            # Gradients are in rotations / meter, but we need rad / meter,
-            # as integrating over exp(-ikr) assumes that kr is a phase in rad
-            b = 1 / 3 * (2 * torch.pi) ** 2 * dt * (k1**2 + k1 * k2 + k2**2).sum(1)
-            """
-            b shape torch.Size([12])
-            b shape torch.Size([12])
-            b shape torch.Size([4117])
-            b shape torch.Size([4117])
-            
-            b shape torch.Size([12])
-            b shape torch.Size([12])
-            b shape torch.Size([4119])
-            b shape torch.Size([4119])
-            
-            b shape torch.Size([15])
-            b shape torch.Size([15])
-            b shape torch.Size([4110])
-            b shape torch.Size([4110])
-            """
-            
-            # shape: events x voxels
-            # applies the well‐known exponential attenuation factor to every voxel at every 
-            # time step, yielding a tensor of shape diffusion.shape == (N_events, X, Y, Z)
-            diffusion = torch.exp(-1e-9 * data.D * torch.cumsum(b, 0)[:, None])
-            """
-            diffusion shape torch.Size([12, 2430])
-            diffusion shape torch.Size([12, 2430])
-            diffusion shape torch.Size([4117, 2430])
-            diffusion shape torch.Size([4117, 2430])
-
-            diffusion shape torch.Size([12, 2430])
-            diffusion shape torch.Size([12, 2430])
-            diffusion shape torch.Size([4119, 2430])
-            diffusion shape torch.Size([4119, 2430])
-
-            diffusion shape torch.Size([15, 2430])
-            diffusion shape torch.Size([15, 2430])
-            diffusion shape torch.Size([4110, 2430])
-            diffusion shape torch.Size([4110, 2430])
-            """
-            # NOTE: We are calculating the signal for samples that are not
-            # measured (adc_usage == 0), which is, depending on the sequence,
-            # produces an overhead of ca. 5 %. On the other hand, this makes
-            # the code much simpler bc. we only have to apply the adc mask
-            # once at the end instead of for every input. Change only if this
-            # performance improvement is worth it. Repetitions without any adc
-            # are already skipped because the pre-pass returns no signal.
+            if diffusion_enabled:
+                k_dist = kt_stack[:, :3]  # shape: dists x 3
+                # shape: dists x events
+                cum_b = (
+                    cum_b_grad
+                    + k_dist @ cum_b_lin.T
+                    + (k_dist**2).sum(1, keepdim=True) * cum_b_sq
+                )
+
+            # NOTE: The trajectory and b-factor are calculated for all events,
+            # because the carry-over needs their final values. All inputs of
+            # the signal kernel are gathered at the measured samples (adc_idx)
+            # first, so the signal is only calculated where it is measured.
 
             # NOTE: The bracketing / order of calculations is suprisingly
             # important for the numerical precision. An error of 4% is achieved
             # just by switching 2pi * (pos @ grad) to 2pi * pos @ grad
 
-            if dist.dist_type == "+" and dist.emitted_signal >= min_emitted_signal:
-                adc_dist_traj = dist_traj[adc, :]
-                if isinstance(motion_phase, torch.Tensor):
-                    adc_motion_phase = motion_phase[adc, :]
-                else:
-                    adc_motion_phase = motion_phase
-
-                T2 = torch.exp(-trajectory[adc, 3:] / torch.abs(data.T2))
-                T2dash = torch.exp(
-                    -torch.abs(adc_dist_traj[:, 3:]) / torch.abs(data.T2dash)
+            # The kernel materialises several (dists x events x voxels)
+            # tensors, so the measured states are processed in batches
+            if max_batch_states is None:
+                batch_size = max(
+                    1, _MAX_BATCH_ELEMENTS // max(1, len(adc_idx) * voxel_count)
                 )
-                rot = torch.exp(
-                    2j
-                    * np.pi
-                    * (
-                        (adc_dist_traj[:, 3:] * data.B0)
-                        + (adc_dist_traj[:, :3] @ data.voxel_pos.T)
-                        + adc_motion_phase
-                    )
+            else:
+                batch_size = max_batch_states
+            # Repetitions without samples aren't worth compiling for
+            rep_kernel = signal_kernel if len(adc_idx) > 0 else _signal_kernel
+            if isinstance(motion_phase, torch.Tensor):
+                adc_motion_phase = motion_phase[adc_idx, :]
+            else:
+                adc_motion_phase = motion_phase
+
+            # Dephasing only depends on k, states starting at the same
+            # k-space position share it. Without autograd, it is evaluated
+            # once per repetition for each distinct starting position.
+            share_dephasing = not dist_traj.requires_grad
+            if share_dephasing and len(emitting) > 0:
+                k_unique, k_inverse = torch.unique(
+                    kt_stack[emitting, :3], dim=0, return_inverse=True
                 )
-                dephasing = data.dephasing_func(adc_dist_traj[:, :3], data.nyquist)[
-                    :, None
-                ]
-
-                # shape: events x voxels
-                transverse_mag = (
-                    # Add event dimension
-                    1.41421356237
-                    * dist.mag.unsqueeze(0)
-                    * rot
-                    * T2
-                    * T2dash
-                    * diffusion[adc, :]
-                    * dephasing
+                adc_k = k_unique[:, None, :] + trajectory[None, adc_idx, :3]
+                # The dephasing function expects a (events x 3) trajectory
+                # shape: distinct k x events
+                unique_dephasing = data.dephasing_func(
+                    adc_k.flatten(0, 1), data.nyquist
+                ).view(adc_k.shape[:2])
+
+            # shape: events x coils
+            rep_signal = 0
+            for start in range(0, len(emitting), batch_size):
+                batch = emitting[start:start + batch_size]
+                # shape: dists x events x 4
+                adc_dist_traj = dist_traj[batch][:, adc_idx, :]
+
+                if share_dephasing:
+                    dephasing = unique_dephasing[
+                        k_inverse[start:start + batch_size]
+                    ]
+                else:
+                    adc_k = adc_dist_traj[:, :, :3]
+                    dephasing = data.dephasing_func(
+                        adc_k.flatten(0, 1), data.nyquist
+                    ).view(adc_k.shape[:2])
+
+                dist_signal, transverse_mag = rep_kernel(
+                    torch.view_as_real(mag_stack[batch]),
+                    adc_dist_traj,
+                    cum_b[batch][:, adc_idx] if diffusion_enabled else None,
+                    trajectory[adc_idx, 3:],
+                    adc_motion_phase,
+                    dephasing,
+                    data.D,
+                    inv_T2,
+                    inv_T2dash,
+                    pos_aug,
+                    coil_weights,
+                    bool(return_mag_adc),
                 )
                 if return_mag_adc:
-                    mag_adc_rep.append(
-                        adc_rot[adc] * transverse_mag * torch.abs(data.PD)
+                    mag_adc_rep.extend(
+                        pd_adc_rot * torch.view_as_complex(transverse_mag)
                     )
+                rep_signal = rep_signal + dist_signal
 
-                # (events x voxels) @ (voxels x coils) = (events x coils)
-                dist_signal = transverse_mag @ coil_sensitivity
-                rep_sig += dist_signal
+            # Collect signal (complex-valued time series). Repetitions
+            # without measured states keep the zeros of the preallocation.
+            if len(emitting) > 0:
+                rep_signal = torch.view_as_complex(
+                    rep_signal.view(-1, coil_count, 2)
+                )
+                signal[adc_offsets[i]:adc_offsets[i + 1]] = rep_signal * adc_rot
 
-            # Prepare each state's dist.mag and kt_vec for the next TR:
-            # Carry‐over: After removing the portion measured at "+", 
-            # the residual magnetization is decayed by T2 (plus diffusion) and 
+            # Carry‐over: After removing the portion measured at "+",
+            # the residual magnetization is decayed by T2 (plus diffusion) and
             # re‐injected as new z-states (T1 recovery) for the next repetition
-            if dist.dist_type == "+":
-                # Diffusion for whole trajectory + T2 relaxation + final phase carried by motion
-                dist.mag = dist.mag * r2 * diffusion[-1, :]
-                if isinstance(motion_phase, torch.Tensor):
-                    dist.mag = dist.mag * torch.exp(2j * np.pi * motion_phase[-1, :])
-                dist.kt_vec = dist_traj[-1]
-            else:  # z or z0
-                k = torch.linalg.vector_norm(dist.kt_vec[:3])
-                diffusion = torch.exp(-1e-9 * data.D * total_time * k**2)
-                dist.mag = dist.mag * r1 * diffusion
-            if dist.dist_type == "z0":
-                dist.mag = dist.mag + 1 - r1
-
-        # Repeat for all TRs, collect signal (complex-valued time series) and return.
-        signal.append(rep_sig * adc_rot[adc])
-        """
-        rep_sig shape torch.Size([0, 1])
-        adc_rot shape torch.Size([12, 1])
-        signal shape torch.Size([0, 1])
-        
-        rep_sig shape torch.Size([4096, 1])
-        adc_rot shape torch.Size([4117, 1])
-        signal shape torch.Size([4096, 1])
-        
-        rep_sig shape torch.Size([0, 1])
-        adc_rot shape torch.Size([12, 1])
-        signal shape torch.Size([0, 1])
-        
-        rep_sig shape torch.Size([4096, 1])
-        adc_rot shape torch.Size([4119, 1])
-        signal shape torch.Size([4096, 1])
-        
-        rep_sig shape torch.Size([0, 1])
-        adc_rot shape torch.Size([15, 1])
-        signal shape torch.Size([0, 1])
-        
-        rep_sig shape torch.Size([4096, 1])
-        adc_rot shape torch.Size([4110, 1])
-        signal shape torch.Size([4096, 1])
-        """
-
-
-        # print("rep_sig shape", rep_sig.shape)
-        # print("adc_rot shape", adc_rot.shape)
-        # print("signal shape", signal[-1].shape)
-
+            # Diffusion for whole trajectory + T2 relaxation + final phase carried by motion
+            mag_stack = mag_stack * r2
+            if diffusion_enabled:
+                mag_stack = mag_stack * torch.exp(-1e-9 * data.D * cum_b[:, -1:])
+            if isinstance(motion_phase, torch.Tensor):
+                mag_stack = mag_stack * torch.polar(
+                    motion_phase.new_ones(()), 2 * np.pi * motion_phase[-1, :]
+                )
+            # Every state gets its own tensors: views would keep the whole
+            # stack alive as long as any state of it is not cleared
+            for j, dist in enumerate(plus_dists):
+                dist.mag = mag_stack[j].clone()
+                dist.kt_vec = dist_traj[j, -1].clone()
 
         if clear_state_mag:
             for dist in dists:
@@ -447,6 +653,6 @@ def execute_graph(
 
     # final signal shape torch.Size([12288, 1]) 4096x3
     if return_mag_adc:
-        return torch.cat(signal), mag_adc
+        return signal, mag_adc
     else:
-        return torch.cat(signal)
\ No newline at end of file
+        return signal
\ No newline at end of file
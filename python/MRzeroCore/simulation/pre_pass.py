@@ -90,10 +90,55 @@ def compute_graph_ext(
     ))
 
 
+# Maps the edge label of an ancestor to the index of the RF coefficient that
+# is applied to it (z_to_z, p_to_p, z_to_p, p_to_z, m_to_z, m_to_p) and
+# whether the ancestor magnetisation must be conjugated first.
+ANCESTOR_OPS = {
+    "zz": (0, False),
+    "++": (1, False),
+    "z+": (2, False),
+    "+z": (3, False),
+    "-z": (4, True),
+    "-+": (5, True),
+}
+
+
 class Graph(list):
     """:class:`Graph` is a wrapper around the list of states returned by the prepass."""
     def __init__(self, graph: list[list[_prepass.PyDistribution]]) -> None:
         super().__init__(graph)
+        self._ancestor_ops = {}
+
+    def ancestor_ops(self, index: int, device: torch.device
+                     ) -> list[tuple[torch.Tensor, torch.Tensor] | None]:
+        """Return the RF mixing opcodes of all states in ``self[index]``.
+
+        For every state with more than one ancestor, this is a tuple of an
+        int64 tensor containing the index of the RF coefficient for every
+        ancestor (see :data:`ANCESTOR_OPS`) and a bool tensor marking the
+        ancestors that are conjugated. States with a single ancestor look up
+        :data:`ANCESTOR_OPS` directly and get ``None``. The tensors are built
+        once per device and cached.
+        """
+        key = (index, str(device))
+        if key not in self._ancestor_ops:
+            ops = []
+            for dist in self[index]:
+                if len(dist.ancestors) <= 1:
+                    ops.append(None)
+                    continue
+                try:
+                    op_idx, conj = zip(*[
+                        ANCESTOR_OPS[edge[0]] for edge in dist.ancestors
+                    ])
+                except KeyError as e:
+                    raise ValueError(f"Unknown transform {e.args[0]}")
+                ops.append((
+                    torch.tensor(op_idx, dtype=torch.long, device=device),
+                    torch.tensor(conj, dtype=torch.bool, device=device),
+                ))
+            self._ancestor_ops[key] = ops
+        return self._ancestor_ops[key]
 
     def plot(self,
              transversal_mag: bool = True,